@@ -3,6 +3,27 @@ import { Button, Form, Row, Col } from 'react-bootstrap';
 import AudioPlayerWithActivation from './AudioPlayerWithActivation';
 import Plot from 'react-plotly.js';
 
+// Decode a base64-encoded little-endian float16 buffer into an array of numbers
+const decodeFloat16Base64 = (b64) => {
+  const bytes = Uint8Array.from(atob(b64), c => c.charCodeAt(0));
+  const view = new DataView(bytes.buffer);
+  const values = new Array(bytes.length / 2);
+  for (let i = 0; i < values.length; i++) {
+    const half = view.getUint16(i * 2, true);
+    const sign = half & 0x8000 ? -1 : 1;
+    const exponent = (half >> 10) & 0x1f;
+    const fraction = half & 0x3ff;
+    if (exponent === 0) {
+      values[i] = sign * Math.pow(2, -14) * (fraction / 1024);
+    } else if (exponent === 0x1f) {
+      values[i] = fraction ? NaN : sign * Infinity;
+    } else {
+      values[i] = sign * Math.pow(2, exponent - 15) * (1 + fraction / 1024);
+    }
+  }
+  return values;
+};
+
 const ActivationSearchTab = ({ isServerReady, nFeatures, API_BASE_URL }) => {
   const [featureIdx, setFeatureIdx] = useState('');
   const [nResults, setNResults] = useState(20);
@@ -77,7 +98,7 @@ const ActivationSearchTab = ({ isServerReady, nFeatures, API_BASE_URL }) => {
       .then(response => response.json())
       .then(data => {
         setTopFiles(data.top_files);
-        setActivations(data.activations);
+        setActivations(data.activations_b64.map(decodeFloat16Base64));
         setMaxPerFile(data.max_per_file);
         setIsLoading(false);
       })
@@ -1,22 +1,138 @@
 import torch
 import json
 import os
+import glob
+import mmap
+import warnings
 import numpy as np
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import (
+    Dataset,
+    DataLoader,
+    BatchSampler,
+    RandomSampler,
+    SequentialSampler,
+)
 from typing import Optional
 
-from src.dataset.audio import AudioDataset
-from src.models.hooked_model import init_cache
+from src.dataset.audio import AudioDataset, collate_mels
+from src.models.hooked_model import init_cache, whisper_uses_fp16
 from src.models.l1autoencoder import L1AutoEncoder
 from src.models.topkautoencoder import TopKAutoEncoder
 from src.models.config import L1AutoEncoderConfig, TopKAutoEncoderConfig
 from src.utils.constants import get_n_mels
 
 
+def _parse_cpulist(cpulist: str) -> set[int]:
+    cpus = set()
+    for part in cpulist.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.update(range(int(start), int(end) + 1))
+        elif part:
+            cpus.add(int(part))
+    return cpus
+
+
+def numa_worker_init_fn(worker_id: int):
+    """
+    Pin each dataloader worker to the CPUs of a single NUMA node, round-robin over nodes
+    """
+    nodes = sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"))
+    if len(nodes) < 2 or not hasattr(os, "sched_setaffinity"):
+        return
+    with open(nodes[worker_id % len(nodes)], "r") as f:
+        cpus = _parse_cpulist(f.read().strip())
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+
+
+def get_dl_kwargs(batch_size: int, dl_max_workers: int, pin_memory: bool) -> dict:
+    """
+    Default DataLoader kwargs. Caps the number of workers at half the available CPUs and keeps
+    workers alive between epochs, each prefetching several batches.
+    """
+    if dl_max_workers > 4:
+        warnings.warn(
+            f"dl_max_workers={dl_max_workers}: more than 4 workers tends to reduce throughput "
+            "due to GIL and queue contention"
+        )
+    num_workers = min(dl_max_workers, (os.cpu_count() or 2) // 2 or 1)
+    dl_kwargs = {
+        "batch_size": batch_size,
+        "num_workers": num_workers,
+        "pin_memory": pin_memory,
+    }
+    if num_workers > 0:
+        dl_kwargs["persistent_workers"] = True
+        dl_kwargs["prefetch_factor"] = 4
+        dl_kwargs["worker_init_fn"] = numa_worker_init_fn
+    return dl_kwargs
+
+
+def open_advised_memmap(
+    path: str, n_rows: Optional[int] = None, willneed_bytes: int = 256 * 2**20
+) -> np.memmap:
+    """
+    Memory-map a .npy file, advising the kernel that the first n_rows (default: all) rows will be
+    read sequentially so that it reads ahead in large runs, and that the remaining rows are not needed.
+    Only the leading willneed_bytes are prefetched at open, the files can be larger than RAM
+    """
+    with open(path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    mm = np.memmap(
+        path,
+        dtype=dtype,
+        mode="r",
+        shape=shape,
+        offset=offset,
+        order="F" if fortran_order else "C",
+    )
+    raw = getattr(mm, "_mmap", None)
+    if raw is None or not hasattr(mmap, "MADV_SEQUENTIAL"):
+        return mm
+    # np.memmap maps from the allocation boundary preceding the header offset
+    data_start = offset % mmap.ALLOCATIONGRANULARITY
+    row_nbytes = mm.nbytes // shape[0] if shape and shape[0] else 0
+    n_rows = shape[0] if not shape or n_rows is None else min(n_rows, shape[0])
+    advised_end = data_start + n_rows * row_nbytes
+    raw.madvise(mmap.MADV_SEQUENTIAL)
+    raw.madvise(mmap.MADV_WILLNEED, 0, min(advised_end, data_start + willneed_bytes))
+    dontneed_start = -(-advised_end // mmap.PAGESIZE) * mmap.PAGESIZE
+    if dontneed_start < len(raw):
+        raw.madvise(mmap.MADV_DONTNEED, dontneed_start, len(raw) - dontneed_start)
+    return mm
+
+
+def get_inference_dtype(device: Optional[str | torch.device]) -> Optional[torch.dtype]:
+    """
+    dtype of the activations produced by WhisperActivationCache on this device, for the SAE to match
+    """
+    return torch.float16 if whisper_uses_fp16(device) else None
+
+
+# older train_sae checkpoints store best_val_loss as a numpy float64
+CHECKPOINT_SAFE_GLOBALS = [
+    np.core.multiarray.scalar,
+    np.dtype,
+    type(np.dtype(np.float64)),
+]
+
+
 def init_sae_from_checkpoint(
-    checkpoint: str, device: Optional[str | torch.device] = None
+    checkpoint: str,
+    device: str | torch.device = "cpu",
+    dtype: Optional[torch.dtype] = None,
 ) -> L1AutoEncoder | TopKAutoEncoder:
-    checkpoint = torch.load(checkpoint, map_location=device)
+    # mmap pages tensors in on demand rather than reading the whole file into host memory first
+    with torch.serialization.safe_globals(CHECKPOINT_SAFE_GLOBALS):
+        checkpoint = torch.load(
+            checkpoint, map_location=device, mmap=True, weights_only=True
+        )
     activation_size = checkpoint["hparams"]["activation_size"]
     if checkpoint["hparams"]["autoencoder_variant"] == "l1":
         cfg = L1AutoEncoderConfig.from_dict(checkpoint["hparams"]["autoencoder_config"])
@@ -26,11 +142,54 @@ def init_sae_from_checkpoint(
             checkpoint["hparams"]["autoencoder_config"]
         )
         model = TopKAutoEncoder(activation_size, cfg)
-    model.load_state_dict(checkpoint["model"])
+    # checkpoint tensors are already on the target device, use them as the parameters without copying
+    model.load_state_dict(checkpoint["model"], assign=True)
     model.eval().to(device)
+    model.requires_grad_(False)
+    if dtype is not None:
+        model.to(dtype=dtype)
+    if isinstance(model, L1AutoEncoder) and torch.device(device).type == "cuda":
+        # encode is a pure function of the (frozen) weights, let inductor fuse the GEMM and ReLU.
+        # No CUDA graphs: the GUI calls encode from several threads and keeps the outputs around
+        model.encode = torch.compile(model.encode, fullgraph=True)
     return model
 
 
+class CUDAPrefetcher:
+    """
+    Wraps a mel dataloader, copying the next batch to the device on a side stream while the
+    current batch is being processed
+    """
+
+    def __init__(self, dataloader: DataLoader, device: str, stream: torch.cuda.Stream):
+        self.dataloader = dataloader
+        self.device = device
+        self.stream = stream
+
+    def _preload(self, loader_iter):
+        try:
+            mels, global_file_names = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            mels = mels.to(self.device, non_blocking=True)
+        return mels, global_file_names
+
+    def __iter__(self):
+        loader_iter = iter(self.dataloader)
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            mels, global_file_names = next_batch
+            # mels was allocated on the copy stream, keep it alive until the compute stream is done
+            mels.record_stream(torch.cuda.current_stream())
+            next_batch = self._preload(loader_iter)
+            yield mels, global_file_names
+
+    def __len__(self):
+        return len(self.dataloader)
+
+
 class FlyActivationDataLoader(torch.utils.data.DataLoader):
     """
     Dataloader for computing Whisper or SAE activations on the fly
@@ -51,28 +210,42 @@ class FlyActivationDataLoader(torch.utils.data.DataLoader):
         self.device = device
         self.whisper_cache = init_cache(whisper_model, layer_name, device)
         self.whisper_cache.model.eval()
+        self.whisper_cache.model.requires_grad_(False)
         self.sae_model = (
-            init_sae_from_checkpoint(sae_checkpoint, device=device) if sae_checkpoint else None
+            init_sae_from_checkpoint(
+                sae_checkpoint, device=device, dtype=get_inference_dtype(device)
+            )
+            if sae_checkpoint
+            else None
         )
         if isinstance(self.sae_model, TopKAutoEncoder):
             self.activation_type = "indexed"
         else:
             self.activation_type = "tensor"
-        self._dataset = AudioDataset(data_path, device, get_n_mels(whisper_model))
+        # CUDA can't be initialised inside forked workers, so compute mels on the CPU when
+        # using workers and copy the (pinned) batch to the device in __iter__
+        mel_device = "cpu" if dl_max_workers > 0 else device
+        self._dataset = AudioDataset(data_path, mel_device, get_n_mels(whisper_model))
         if subset_size:
             self._dataset = torch.utils.data.Subset(self._dataset, range(subset_size))
         dl_kwargs = {
-            "batch_size": batch_size,
-            "num_workers": dl_max_workers,
+            **get_dl_kwargs(
+                batch_size, dl_max_workers, torch.device(device).type == "cuda"
+            ),
+            "collate_fn": collate_mels,
             **dl_kwargs,
         }
         self._dataloader = DataLoader(self._dataset, **dl_kwargs)
+        self._copy_stream = (
+            torch.cuda.Stream() if torch.device(device).type == "cuda" else None
+        )
         self.activation_shape = self._get_activation_shape()
         self.dataset_length = len(self._dataset)
 
     def _get_activation_shape(self):
         mels, _ = self._dataset[0]
-        with torch.no_grad():
+        mels = mels.to(self.device)
+        with torch.inference_mode():
             self.whisper_cache.forward(mels)
             first_activation = self.whisper_cache.activations[0]
             if isinstance(self.sae_model, L1AutoEncoder):
@@ -88,26 +261,32 @@ class FlyActivationDataLoader(torch.utils.data.DataLoader):
                 return first_activation.squeeze().shape
 
     def __iter__(self):
-        for batch in self._dataloader:
-            self.whisper_cache.reset_state()
-            mels, global_file_names = batch
-            self.whisper_cache.forward(mels)
-            activations = self.whisper_cache.activations.to(self.device)
-            if isinstance(self.sae_model, L1AutoEncoder):
-                encoded = self.sae_model.encode(activations)
-                latent = encoded.latent.detach().clone()
-                del encoded
-                del activations
-                yield latent, global_file_names
-            elif isinstance(self.sae_model, TopKAutoEncoder):
-                encoded = self.sae_model.encode(activations)
-                top_acts = encoded.top_acts.detach().clone()
-                top_indices = encoded.top_indices.detach().clone()
-                del encoded
+        batches = (
+            CUDAPrefetcher(self._dataloader, self.device, self._copy_stream)
+            if self._copy_stream is not None
+            else self._dataloader
+        )
+        for batch in batches:
+            # grad mode is thread-local, so never yield from inside inference_mode
+            with torch.inference_mode():
+                self.whisper_cache.reset_state()
+                mels, global_file_names = batch
+                mels = mels.to(self.device, non_blocking=True)
+                self.whisper_cache.forward(mels)
+                activations = self.whisper_cache.activations.to(self.device).contiguous()
+                if isinstance(self.sae_model, L1AutoEncoder):
+                    encoded = self.sae_model.encode(activations)
+                    out = (encoded.latent.clone(),)
+                elif isinstance(self.sae_model, TopKAutoEncoder):
+                    encoded = self.sae_model.encode(activations)
+                    out = (encoded.top_acts.clone(), encoded.top_indices.clone())
+                else:
+                    out = (activations,)
                 del activations
-                yield top_acts, top_indices, global_file_names
-            else:
-                yield activations, global_file_names
+            if self.sae_model is None:
+                # raw activations may be used to train an SAE, which can't save inference tensors for backward
+                out = (out[0].clone(),)
+            yield *out, global_file_names
 
     def __len__(self):
         return len(self._dataloader)
@@ -136,11 +315,11 @@ class MemoryMappedActivationsDataset(Dataset):
                 data_path, f"{layer_name}_feature_indices.npy"
             )
             self.activation_type = "indexed"
-            self.act_mmap = np.load(self.activation_value_file, mmap_mode="r")
-            self.idx_mmap = np.load(self.feature_index_file, mmap_mode="r")
+            self.act_mmap = open_advised_memmap(self.activation_value_file, subset_size)
+            self.idx_mmap = open_advised_memmap(self.feature_index_file, subset_size)
         else:
             self.activation_type = "tensor"
-            self.mmap = np.load(self.tensor_file, mmap_mode="r")
+            self.mmap = open_advised_memmap(self.tensor_file, subset_size)
         if subset_size is not None:
             self.metadata["filenames"] = self.metadata["filenames"][:subset_size]
             if self.activation_type == "indexed":
@@ -149,6 +328,14 @@ class MemoryMappedActivationsDataset(Dataset):
             else:
                 self.mmap = self.mmap[:subset_size]
         self.activation_shape = self._get_activation_shape()
+        self._row_shape = tuple(self.metadata["tensor_shape"])
+        self.dtype = (
+            self.act_mmap if self.activation_type == "indexed" else self.mmap
+        ).dtype
+        if "dtype" in self.metadata and np.dtype(self.metadata["dtype"]) != self.dtype:
+            raise ValueError(
+                f"Activations stored as {self.dtype}, but metadata specifies {self.metadata['dtype']}"
+            )
 
     def _get_activation_shape(self):
         return self.metadata["activation_shape"]
@@ -157,21 +344,37 @@ class MemoryMappedActivationsDataset(Dataset):
         return len(self.metadata["filenames"])
 
     def __getitem__(self, idx):
-        filename = self.metadata["filenames"][idx]
+        # rows are read a whole batch at a time in collate
+        return idx, self.metadata["filenames"][idx]
+
+    def _read_rows(self, mmap: np.ndarray, indices: list[int]) -> torch.Tensor:
+        start, stop = indices[0], indices[-1] + 1
+        if stop - start == len(indices) and indices == list(range(start, stop)):
+            rows = mmap[start:stop].copy()
+        else:
+            rows = mmap[indices]
+        return torch.from_numpy(rows.reshape(-1, *self._row_shape))
 
+    def collate(self, batch: list[tuple[int, str]]):
+        indices = [b[0] for b in batch]
+        filenames = [b[1] for b in batch]
         if self.activation_type == "indexed":
-            act_data = self.act_mmap[idx]
-            act_data = torch.from_numpy(act_data.reshape(self.metadata["tensor_shape"]))
-            idx_data = self.idx_mmap[idx]
-            idx_data = torch.from_numpy(idx_data.reshape(self.metadata["tensor_shape"]))
-            return act_data, idx_data, filename
+            act_data = self._read_rows(self.act_mmap, indices)
+            idx_data = self._read_rows(self.idx_mmap, indices)
+            return act_data, idx_data, filenames
         else:
-            tensor_data = self.mmap[idx]
-            tensor = torch.from_numpy(
-                tensor_data.reshape(self.metadata["tensor_shape"])
-            )
+            return self._read_rows(self.mmap, indices), filenames
 
-            return tensor, filename
+
+class SortedBatchSampler(BatchSampler):
+    """
+    BatchSampler that sorts the indices within each batch, so that reads from the memory-mapped
+    files walk forwards through the file (and sequential batches become contiguous slices)
+    """
+
+    def __iter__(self):
+        for batch in super().__iter__():
+            yield sorted(batch)
 
 
 class MemoryMappedActivationDataLoader(torch.utils.data.DataLoader):
@@ -193,14 +396,26 @@ class MemoryMappedActivationDataLoader(torch.utils.data.DataLoader):
             data_path, layer_name, subset_size
         )
         dl_kwargs = {
-            "batch_size": batch_size,
-            "num_workers": dl_max_workers,
+            **get_dl_kwargs(batch_size, dl_max_workers, torch.cuda.is_available()),
             **dl_kwargs,
         }
-        super().__init__(self._dataset, **dl_kwargs)
+        sampler = (
+            RandomSampler(self._dataset)
+            if dl_kwargs.pop("shuffle", False)
+            else SequentialSampler(self._dataset)
+        )
+        batch_sampler = SortedBatchSampler(
+            sampler, dl_kwargs.pop("batch_size"), dl_kwargs.pop("drop_last", False)
+        )
+        super().__init__(
+            self._dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self._dataset.collate,
+            **dl_kwargs,
+        )
         self.activation_shape = self.dataset.activation_shape
         self.activation_type = self.dataset.activation_type
         self.dataset_length = len(self._dataset)
 
     def __len__(self):
-        return len(self._dataset) // self.batch_size
+        return len(self.batch_sampler)
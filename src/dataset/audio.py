@@ -1,5 +1,6 @@
 import os
 import torch
+from dataclasses import dataclass
 
 from src.utils.audio_utils import get_mels_from_audio_path, is_audio_file
 
@@ -45,3 +46,28 @@ class AudioDataset(torch.utils.data.Dataset):
 
     def __len__(self) -> int:
         return len(self.audio_files)
+
+
+@dataclass
+class MelBatch:
+    """
+    Collated batch from AudioDataset. Implements pin_memory so that DataLoader(pin_memory=True)
+    skips mels that are already on the GPU (AudioDataset builds them there when the DataLoader has
+    no workers), which the default pinning logic would raise on.
+    """
+
+    mels: torch.Tensor
+    filenames: list[str]
+
+    def pin_memory(self):
+        if not self.mels.is_cuda:
+            self.mels = self.mels.pin_memory()
+        return self
+
+    def __iter__(self):
+        return iter((self.mels, self.filenames))
+
+
+def collate_mels(batch: list[tuple[torch.Tensor, str]]) -> MelBatch:
+    mels, filenames = zip(*batch)
+    return MelBatch(mels=torch.stack(mels), filenames=list(filenames))
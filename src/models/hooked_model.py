@@ -9,6 +9,13 @@ import whisper
 from src.utils.audio_utils import get_mels_from_audio_path
 
 
+def whisper_uses_fp16(device: Optional[str | torch.device]) -> bool:
+    """
+    Whether the Whisper wrappers decode, and so produce activations, in fp16 on this device
+    """
+    return torch.device(device or "cpu").type == "cuda"
+
+
 class BaseActivationModule(ABC):
     def __init__(
         self,
@@ -25,9 +32,16 @@ class BaseActivationModule(ABC):
         self.model = model
         self.step = 0
         self.activations = None
+        self._activation_buffer = []
         self.hooks = []
         self.layer_to_cache = layer_to_cache
         self.hook_fn = hook_fn
+        # resolve the hooked module once rather than walking the module tree on every forward
+        self._modules_to_hook = [
+            (name, module)
+            for name, module in model.named_modules()
+            if name == layer_to_cache
+        ]
 
     def forward(self, x: Float[Tensor, "bsz seq_len n_mels"]):  # noqa: F821
         self.model.zero_grad()
@@ -35,8 +49,17 @@ class BaseActivationModule(ABC):
         self.register_hooks()
         model_out = self.custom_forward(self.model, x)
         self.remove_hooks()
+        self._collect_activations()
         return model_out
 
+    def _collect_activations(self):
+        # activations stay on the model's device, consumers (e.g. the SAE) run there as well
+        if len(self._activation_buffer) == 1:
+            self.activations = self._activation_buffer[0]
+        elif self._activation_buffer:
+            self.activations = torch.cat(self._activation_buffer, dim=1)
+        self._activation_buffer = []
+
     def substituted_forward(
         self,
         x: Float[Tensor, "bsz seq_len n_mels"],
@@ -45,21 +68,17 @@ class BaseActivationModule(ABC):
         pass
 
     def register_hooks(self):
-        for name, module in self.model.named_modules():
-            if name == self.layer_to_cache:
-                hook_fn = (
-                    self.hook_fn
-                    if self.hook_fn is not None
-                    else self._get_caching_hook(name)
-                )
-                forward_hook = module.register_forward_hook(hook_fn)
-                self.hooks.append(forward_hook)
+        for name, module in self._modules_to_hook:
+            hook_fn = (
+                self.hook_fn if self.hook_fn is not None else self._get_caching_hook(name)
+            )
+            forward_hook = module.register_forward_hook(hook_fn)
+            self.hooks.append(forward_hook)
 
     def _get_caching_hook(self, name):
         def hook(module, input, output):
-            output_ = output.detach().cpu()
-            # assume that we go through each layer only once
-            self.activations = output_
+            # buffered on device and concatenated once at the end of forward
+            self._activation_buffer.append(output.detach())
 
         return hook
 
@@ -81,6 +100,7 @@ class BaseActivationModule(ABC):
 
     def reset_state(self):
         self.activations = None
+        self._activation_buffer = []
 
 
 class WhisperActivationCache(BaseActivationModule):
@@ -104,7 +124,7 @@ class WhisperActivationCache(BaseActivationModule):
         self, model: torch.nn.Module, mels: Float[Tensor, "bsz seq_len n_mels"]
     ):  # noqa: F821
         options = whisper.DecodingOptions(
-            without_timestamps=False, fp16=(self.device == torch.device("cuda"))
+            without_timestamps=False, fp16=whisper_uses_fp16(self.device)
         )
         output = model.decode(mels, options)
         return output
@@ -112,8 +132,7 @@ class WhisperActivationCache(BaseActivationModule):
     def _get_caching_hook(self, name):
         # custom caching function for whisper
         def hook(module, input, output):
-            output_ = output.detach().cpu()
-            self.activations = output_
+            self._activation_buffer.append(output.detach())
 
         return hook
 
@@ -133,6 +152,12 @@ class WhisperSubbedActivation(torch.nn.Module):
         self.model = model
         self.device = device
         self.substitution_layer = substitution_layer
+        # kept in a list so nn.Module doesn't register it as a duplicate submodule
+        self._modules_to_sub = [
+            module
+            for name, module in model.named_modules()
+            if name == substitution_layer
+        ]
 
     def forward(
         self, mels: Float[Tensor, "bsz seq_len n_mels"], substitute_activation: Tensor
@@ -141,7 +166,7 @@ class WhisperSubbedActivation(torch.nn.Module):
         if substitute_activation is not None:
             forward_hook = self.register_hook(substitute_activation)
         options = whisper.DecodingOptions(
-            without_timestamps=False, fp16=(self.device == torch.device("cuda"))
+            without_timestamps=False, fp16=whisper_uses_fp16(self.device)
         )
         output = self.model.decode(mels, options)
         if substitute_activation is not None:
@@ -149,11 +174,9 @@ class WhisperSubbedActivation(torch.nn.Module):
         return output
 
     def register_hook(self, substitution_activation: Tensor):
-        for name, module in self.model.named_modules():
-            if name == self.substitution_layer:
-                hook_fn = self._get_substitution_hook(substitution_activation)
-                forward_hook = module.register_forward_hook(hook_fn)
-                return forward_hook
+        for module in self._modules_to_sub:
+            hook_fn = self._get_substitution_hook(substitution_activation)
+            return module.register_forward_hook(hook_fn)
 
     def _get_substitution_hook(self, substitution_activation):
         def hook(module, input, output):
@@ -62,16 +62,30 @@ class L1AutoEncoder(nn.Module):
         # Initialize the decoder weights orthogonally
         nn.init.orthogonal_(self.decoder.weight)
 
-        # Encoder is a Sequential with the ReLU activation
         # No need to define a Linear layer for the encoder as its weights are tied with the decoder
-        self.encoder = nn.Sequential(nn.ReLU())
 
-    def encode(self, x: Float[Tensor, "bsz seq_len d_model"]):  # noqa: F821
+    @torch.no_grad()
+    def renormalize_decoder(self):
         # Apply unit norm constraint to the decoder weights
         self.decoder.weight.data = nn.functional.normalize(
             self.decoder.weight.data, dim=0
         )
-        c = self.encoder(x @ self.decoder.weight + self.encoder_bias)
+
+    def train(self, mode: bool = True):
+        super().train(mode)
+        if not mode:
+            # weights are frozen in eval mode, so normalize once here instead of in every encode
+            self.renormalize_decoder()
+        return self
+
+    def encode(self, x: Float[Tensor, "bsz seq_len d_model"]):  # noqa: F821
+        if self.training:
+            self.renormalize_decoder()
+        x = x.to(self.decoder.weight.dtype)
+        # equivalent to relu(x @ W + b), with the bias add folded into the GEMM
+        c = nn.functional.relu(
+            nn.functional.linear(x, self.decoder.weight.T, self.encoder_bias)
+        )
         return L1EncoderOutput(latent=c)
 
     def decode(self, c: Float[Tensor, "bsz seq_len n_dict_components"]):  # noqa: F821
@@ -82,8 +96,17 @@ class L1AutoEncoder(nn.Module):
     ):  # noqa: F821
         c = self.encode(x).latent
         x_hat = self.decoder(c)
-        loss_l1 = torch.norm(c, 1, dim=2).mean()
-        loss_recon = self.recon_alpha * mse_loss(x_hat, x, -1, "mean")
+        # keep the norm in fp32 when the model runs in half precision
+        loss_l1 = torch.norm(c.float(), 1, dim=2).mean()
+        # compute the squared error once, for both the reconstruction loss and the mse
+        squared_error = (x_hat - x) ** 2
+        mse = squared_error.mean()
+        # same as mse_loss(x_hat, x, -1, "mean"), activations are almost never exactly -1
+        ignored = x == -1
+        if ignored.any():
+            loss_recon = self.recon_alpha * squared_error[~ignored].mean()
+        else:
+            loss_recon = self.recon_alpha * mse
         forward_output = L1ForwardOutput(
             sae_out=x_hat,
             encoded=L1EncoderOutput(c),
@@ -91,5 +114,5 @@ class L1AutoEncoder(nn.Module):
             reconstruction_loss=loss_recon,
         )
         if return_mse:
-            return forward_output, ((x_hat - x) ** 2).mean()
+            return forward_output, mse
         return forward_output
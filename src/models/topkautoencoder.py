@@ -71,7 +71,7 @@ class TopKAutoEncoder(nn.Module):
 
     def pre_acts(self, x: Tensor) -> Tensor:
         # Remove decoder bias as per Anthropic
-        sae_in = x - self.b_dec
+        sae_in = x.to(self.b_dec.dtype) - self.b_dec
         out = self.encoder(sae_in)
 
         return nn.functional.relu(out)
@@ -2,6 +2,7 @@ import argparse
 import json
 import os
 import torch
+import numpy as np
 from pathlib import Path
 from tqdm import tqdm
 from typing import Optional, List
@@ -16,6 +17,7 @@ def save_data_for_memory_mapping(
     filenames: List[str],
     tensor_shape: List[int],
     activation_shape: List[int],
+    dtype: str = "float16",
 ):
     """
     Append data to memory-mappable file(s) and update metadata
@@ -24,6 +26,7 @@ def save_data_for_memory_mapping(
     :param data_files: List of paths to the data file(s)
     :param data: List of data tensors to save
     :param filenames: List of filenames corresponding to the data
+    :param dtype: dtype to store floating point data (activation values) as
     """
     assert len(data[0]) == len(
         filenames
@@ -37,6 +40,7 @@ def save_data_for_memory_mapping(
         metadata = {
             "tensor_shape": tensor_shape,
             "activation_shape": activation_shape,
+            "dtype": dtype,
             "filenames": [],
         }
 
@@ -50,7 +54,10 @@ def save_data_for_memory_mapping(
                     f"All tensors must have the same shape as the first tensor. "
                     f"Expected {metadata['tensor_shape'][i]}, got {tensor.shape}"
                 )
-            new_data[i].append(tensor.cpu().numpy())
+            array = tensor.cpu().numpy()
+            if np.issubdtype(array.dtype, np.floating):
+                array = array.astype(metadata["dtype"], copy=False)
+            new_data[i].append(array)
 
     # Save updated metadata
     with open(metadata_file, "w") as f:
@@ -73,6 +80,7 @@ def get_activations(
     out_folder: str,
     max_workers: int,
     collect_max: Optional[int],
+    save_dtype: str = "float16",
 ):
     """
     Collect activations from whisper_model or sae_model
@@ -86,6 +94,7 @@ def get_activations(
     :param out_folder: Output folder for saving data
     :param max_workers: Maximum number of workers for dataloader
     :param collect_max: Maximum number of samples to collect (optional)
+    :param save_dtype: dtype to store activation values as
     """
     dataloader = FlyActivationDataLoader(
         data_path,
@@ -133,6 +142,7 @@ def get_activations(
                 global_filenames,
                 tensor_shape,
                 dataloader.activation_shape,
+                save_dtype,
             )
 
 
@@ -154,6 +164,7 @@ def main():
         config["out_folder"],
         config["dl_max_workers"],
         config.get("collect_max"),
+        config.get("save_dtype", "float16"),
     )
 
 
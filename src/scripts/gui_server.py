@@ -1,27 +1,33 @@
 from typing import Optional, Tuple, Callable
 import torch
 import argparse
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, Response, jsonify, request, send_file
 from flask_cors import CORS
+import base64
 import json
+import threading
+import urllib.parse
+import orjson
+from gunicorn.app.base import BaseApplication
 import soundfile as sf
-import io
 import numpy as np
 
 from src.dataset.activations import (
     MemoryMappedActivationDataLoader,
     FlyActivationDataLoader,
     init_sae_from_checkpoint,
+    get_inference_dtype,
 )
 from src.utils.activations import (
     top_activations,
+    top_activations_from_extrema,
+    load_feature_extrema,
     top_activations_for_audio,
     manipulate_latent,
 )
 from src.models.hooked_model import (
     init_cache,
     WhisperActivationCache,
-    init_subbed,
     WhisperSubbedActivation,
 )
 from src.models.l1autoencoder import L1AutoEncoder
@@ -39,7 +45,11 @@ class GlobalState:
     whisper_cache: Optional[WhisperActivationCache] = None
     sae_model: Optional[L1AutoEncoder | TopKAutoEncoder] = None
     whisper_subbed: Optional[WhisperSubbedActivation] = None
+    whisper_loader: Optional[Callable[[], WhisperActivationCache]] = None
     allow_audio_upload: bool = True
+    audio_redirect_prefix: Optional[str] = None
+    # the models hold per-call hook state, so requests served on different threads take turns
+    model_lock: threading.Lock = threading.Lock()
 
 
 def get_gui_data(
@@ -48,9 +58,9 @@ def get_gui_data(
     callable,
     int,
     str,
-    WhisperActivationCache,
+    Optional[WhisperActivationCache],
     L1AutoEncoder | TopKAutoEncoder,
-    WhisperSubbedActivation,
+    Callable[[], WhisperActivationCache],
 ]:
     if from_disk:
         dataloader = MemoryMappedActivationDataLoader(
@@ -60,14 +70,33 @@ def get_gui_data(
             dl_max_workers=config["dl_max_workers"],
             subset_size=files_to_search,
         )
-        whisper_cache = init_cache(
-            config["whisper_model"], config["layer_name"], config["device"]
+        # activation search reads from disk, so only load Whisper once audio is uploaded
+        whisper_cache = None
+        whisper_loader = lambda: init_cache(
+            config["whisper_model"],
+            config["layer_name"],
+            config["device"],
         )
         sae_model = (
-            init_sae_from_checkpoint(config["sae_model"], config["device"])
+            init_sae_from_checkpoint(
+                config["sae_model"],
+                config["device"],
+                get_inference_dtype(config["device"]),
+            )
             if config["sae_model"] is not None
             else None
         )
+        extrema = load_feature_extrema(dataloader.dataset)
+        top_fn = lambda feature_idx, n_files, max_val, min_val, absolute_magnitude, return_max_per_file: top_activations_from_extrema(
+            dataloader.dataset,
+            extrema,
+            feature_idx,
+            n_files,
+            max_val,
+            min_val,
+            absolute_magnitude,
+            return_max_per_file,
+        )
     else:
         dataloader = FlyActivationDataLoader(
             config["data_path"],
@@ -80,31 +109,53 @@ def get_gui_data(
             subset_size=files_to_search,
         )
         whisper_cache = dataloader.whisper_cache
+        whisper_loader = lambda: dataloader.whisper_cache
         sae_model = dataloader.sae_model
-    whisper_subbed = init_subbed(
-        config["whisper_model"], config["layer_name"], config["device"]
-    )
+
+        def top_fn(
+            feature_idx, n_files, max_val, min_val, absolute_magnitude, return_max_per_file
+        ):
+            # the search runs the shared Whisper cache and SAE, the disk-backed search only reads mmaps
+            with GlobalState.model_lock:
+                return top_activations(
+                    dataloader,
+                    feature_idx,
+                    n_files,
+                    max_val,
+                    min_val,
+                    absolute_magnitude,
+                    return_max_per_file,
+                )
+
     activation_shape = dataloader.activation_shape
     n_features = activation_shape[-1]
     layer_name = config["layer_name"]
     return (
-        lambda feature_idx, n_files, max_val, min_val, absolute_magnitude, return_max_per_file: top_activations(
-            dataloader,
-            feature_idx,
-            n_files,
-            max_val,
-            min_val,
-            absolute_magnitude,
-            return_max_per_file,
-        ),
+        top_fn,
         n_features,
         layer_name,
         whisper_cache,
         sae_model,
-        whisper_subbed,
+        whisper_loader,
     )
 
 
+def get_whisper_models() -> tuple[WhisperActivationCache, WhisperSubbedActivation]:
+    """
+    Load Whisper on first use. The substitution model shares the cache's weights.
+    Must be called while holding GlobalState.model_lock.
+    """
+    if GlobalState.whisper_cache is None:
+        GlobalState.whisper_cache = GlobalState.whisper_loader()
+    if GlobalState.whisper_subbed is None:
+        GlobalState.whisper_subbed = WhisperSubbedActivation(
+            model=GlobalState.whisper_cache.model,
+            substitution_layer=GlobalState.layer_name,
+            device=GlobalState.whisper_cache.device,
+        )
+    return GlobalState.whisper_cache, GlobalState.whisper_subbed
+
+
 def get_top_activations(
     top_fn: Callable,
     feature_idx: int,
@@ -113,16 +164,49 @@ def get_top_activations(
     min_val: Optional[float],
     absolute_magnitude: bool,
     return_max_per_file: bool,
-) -> Tuple[list[str], list[torch.Tensor], list[float]]:
+) -> Tuple[list[str], list[np.ndarray], Optional[np.ndarray]]:
     top, max_per_file = top_fn(
         feature_idx, n_files, max_val, min_val, absolute_magnitude, return_max_per_file
     )
     top_files = [x[0] for x in top]
-    activations = [x[1] for x in top]
+    # convert to float16 numpy once, this is what gets serialized
+    activations = [x[1].detach().to(torch.float16).cpu().numpy() for x in top]
+    if max_per_file is not None:
+        max_per_file = np.asarray(max_per_file, dtype=np.float32)
     print("Got top activations.")
     return top_files, activations, max_per_file
 
 
+def encode_activation(activation: np.ndarray) -> str:
+    """
+    Pack an activation as a base64-encoded little-endian float16 buffer, avoiding a boxed
+    Python float per value
+    """
+    return base64.b64encode(activation.astype("<f2", copy=False).tobytes()).decode()
+
+
+def stream_top_files(
+    top_files: list[str],
+    activations: list[np.ndarray],
+    max_per_file: Optional[np.ndarray],
+):
+    """
+    Yield the /top_files JSON response in chunks, one chunk per encoded activation
+    """
+    yield (
+        b'{"top_files":'
+        + orjson.dumps(top_files)
+        + b',"max_per_file":'
+        + orjson.dumps(max_per_file, option=orjson.OPT_SERIALIZE_NUMPY)
+        + b',"shapes":'
+        + orjson.dumps([list(a.shape) for a in activations])
+        + b',"dtype":"float16","activations_b64":['
+    )
+    for i, activation in enumerate(activations):
+        yield (b"," if i else b"") + orjson.dumps(encode_activation(activation))
+    yield b"]}"
+
+
 def init_gui_data(
     config_path: str,
     from_disk: bool,
@@ -137,7 +221,7 @@ def init_gui_data(
         GlobalState.layer_name,
         GlobalState.whisper_cache,
         GlobalState.sae_model,
-        GlobalState.whisper_subbed,
+        GlobalState.whisper_loader,
     ) = get_gui_data(config, from_disk, files_to_search)
     GlobalState.allow_audio_upload = not no_audio_upload
     print("GUI data initialized.")
@@ -175,18 +259,35 @@ def get_top_files():
     top_files, activations, max_per_file = get_top_activations(
         GlobalState.top_fn, **args
     )
-    return jsonify(
-        {
-            "top_files": top_files,
-            "activations": [x.tolist() for x in activations],
-            "max_per_file": max_per_file,
-        }
+    return Response(
+        stream_top_files(top_files, activations, max_per_file),
+        mimetype="application/json",
     )
 
 
+AUDIO_MAX_AGE_S = 86400
+
+
 @app.route("/audio/<path:filename>", methods=["GET"])
 def serve_audio(filename):
-    return send_file(f"/{filename}", mimetype="audio/flac")
+    if GlobalState.audio_redirect_prefix is not None:
+        # let a fronting nginx send the file (and handle Range requests) via sendfile(2)
+        response = Response(mimetype="audio/flac")
+        response.headers["X-Accel-Redirect"] = (
+            GlobalState.audio_redirect_prefix.rstrip("/")
+            + "/"
+            + urllib.parse.quote(filename)
+        )
+        response.headers["Cache-Control"] = f"public, max-age={AUDIO_MAX_AGE_S}"
+    else:
+        # conditional responses honour Range, so seeking doesn't re-download the clip
+        response = send_file(
+            f"/{filename}",
+            mimetype="audio/flac",
+            conditional=True,
+            max_age=AUDIO_MAX_AGE_S,
+        )
+    return response
 
 
 def process_uploaded_audio(request):
@@ -197,15 +298,18 @@ def process_uploaded_audio(request):
     if audio_file.filename == "":
         raise ValueError("No selected file")
 
-    audio, sr = sf.read(io.BytesIO(audio_file.read()))
+    # decode straight from the upload stream into float32, without an intermediate bytes copy
+    audio, sr = sf.read(audio_file.stream, dtype="float32", always_2d=False)
+    if audio.ndim == 2:
+        audio = audio.mean(axis=1, dtype=np.float32)
     if sr != SAMPLE_RATE:
         # resample to 16 kHz
         resampled_len = int(len(audio) * SAMPLE_RATE / sr)
         audio = np.interp(
             np.linspace(0, len(audio) - 1, resampled_len), np.arange(len(audio)), audio
-        )
+        ).astype(np.float32)
 
-    return np.array(audio)
+    return audio
 
 
 @app.route("/top_features", methods=["POST"])
@@ -217,9 +321,11 @@ def upload_and_get_top_features():
 
     top_n = int(request.args.get("top_n", 32))
 
-    top_indices, top_activations = top_activations_for_audio(
-        audio_np, GlobalState.whisper_cache, GlobalState.sae_model, top_n
-    )
+    with GlobalState.model_lock:
+        whisper_cache, _ = get_whisper_models()
+        top_indices, top_activations = top_activations_for_audio(
+            audio_np, whisper_cache, GlobalState.sae_model, top_n
+        )
     return jsonify(
         {
             "top_indices": top_indices,
@@ -238,20 +344,22 @@ def upload_and_manipulate_audio():
     feat_idx = int(request.args.get("feat_idx", 0))
     manipulation_factor = float(request.args.get("manipulation_factor", 1.5))
 
-    (
-        baseline_text,
-        manipulated_text,
-        standard_text,
-        standard_activations,
-        manipulated_activations,
-    ) = manipulate_latent(
-        audio_np,
-        GlobalState.whisper_cache,
-        GlobalState.sae_model,
-        GlobalState.whisper_subbed,
-        feat_idx,
-        manipulation_factor,
-    )
+    with GlobalState.model_lock:
+        whisper_cache, whisper_subbed = get_whisper_models()
+        (
+            baseline_text,
+            manipulated_text,
+            standard_text,
+            standard_activations,
+            manipulated_activations,
+        ) = manipulate_latent(
+            audio_np,
+            whisper_cache,
+            GlobalState.sae_model,
+            whisper_subbed,
+            feat_idx,
+            manipulation_factor,
+        )
 
     return jsonify(
         {
@@ -265,13 +373,38 @@ def upload_and_manipulate_audio():
 
 
 def create_app(
-    config_path=None, from_disk=False, files_to_search=None, no_audio_upload=False
+    config_path=None,
+    from_disk=False,
+    files_to_search=None,
+    no_audio_upload=False,
+    audio_redirect_prefix=None,
 ):
+    GlobalState.audio_redirect_prefix = audio_redirect_prefix
     if config_path:
         init_gui_data(config_path, from_disk, files_to_search, no_audio_upload)
     return app
 
 
+class GUIServer(BaseApplication):
+    """
+    Serves the app with gunicorn. The app is created in load(), which runs inside the worker
+    after forking, since a CUDA context can't survive a fork. Use a single worker with several
+    threads so that all requests share one copy of the models.
+    """
+
+    def __init__(self, app_kwargs: dict, options: dict):
+        self.app_kwargs = app_kwargs
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return create_app(**self.app_kwargs)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -291,8 +424,32 @@ if __name__ == "__main__":
         action="store_true",
         help="Whether to disable audio upload functionality",
     )
-    args = parser.parse_args()
-    init_gui_data(
-        args.config, args.from_disk, args.files_to_search, args.no_audio_upload
+    parser.add_argument(
+        "--audio_redirect_prefix",
+        type=str,
+        default=None,
+        help="Internal nginx location to serve audio files from via X-Accel-Redirect (None to serve from Flask)",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=4,
+        help="Number of threads serving requests",
     )
-    app.run(debug=True, host="0.0.0.0", port=5555, use_reloader=False)
+    args = parser.parse_args()
+    GUIServer(
+        {
+            "config_path": args.config,
+            "from_disk": args.from_disk,
+            "files_to_search": args.files_to_search,
+            "no_audio_upload": args.no_audio_upload,
+            "audio_redirect_prefix": args.audio_redirect_prefix,
+        },
+        {
+            "bind": "0.0.0.0:5555",
+            "workers": 1,
+            "threads": args.threads,
+            # model loading and activation search can take longer than the default 30s
+            "timeout": 0,
+        },
+    ).run()
@@ -168,7 +168,8 @@ def validate(
     for i, datapoints in tqdm(enumerate(val_loader), total=len(val_loader)):
         with torch.no_grad(), context_manager:
             activations, filenames = datapoints
-            activations = activations.to(device)
+            # activations may be stored in half precision, compute losses in fp32
+            activations = activations.to(device, non_blocking=True).float()
             filenames = filenames[0]
             out, mse = model(activations, return_mse=True)
             mses.append(mse.item())
@@ -419,7 +420,7 @@ def train(
         pbar = tqdm(enumerate(train_loader), total=len(train_loader), desc=f"Training")
 
         for batch_idx, (activations, _) in pbar:
-            activations = activations.to(device)
+            activations = activations.to(device, non_blocking=True).float()
 
             if isinstance(model, TopKAutoEncoder):
                 did_fire = torch.zeros(
@@ -589,7 +590,8 @@ def train(
                 )
                 if save_loss < state["best_val_loss"]:
                     print("Saving new best validation")
-                    state["best_val_loss"] = save_loss
+                    # plain float so that checkpoints load with weights_only=True
+                    state["best_val_loss"] = float(save_loss)
                     save_checkpoint(state, checkpoint_out_dir + "/bestval.pth")
                     pytorch_model_path = model_out[:-3] + ".bestval"
                     torch.save(model, pytorch_model_path)
@@ -1,4 +1,6 @@
-from typing import Optional
+from typing import NamedTuple, Optional
+import os
+import warnings
 import torch
 import torchaudio
 from tqdm import tqdm
@@ -7,6 +9,7 @@ import numpy as np
 from src.utils.constants import SAMPLE_RATE, TIMESTEP_S
 from src.dataset.activations import (
     MemoryMappedActivationDataLoader,
+    MemoryMappedActivationsDataset,
     FlyActivationDataLoader,
 )
 from src.models.l1autoencoder import L1EncoderOutput, L1AutoEncoder
@@ -16,17 +19,34 @@ from src.utils.audio_utils import get_mels_from_np_array
 from src.utils.constants import get_n_mels
 
 
-def trim_activation(audio_fname: str, activation: torch.Tensor) -> torch.Tensor:
+def activation_length_from_audio_path(audio_fname: str) -> int:
     """
-    Trim the activation tensor to match the duration of the audio file
+    Get the number of frames in the activation tensor from an audio file
     """
     audio = torchaudio.load(audio_fname)[0]
     if audio.shape[0] == 2:
         audio = audio.mean(dim=0)
     audio_sample_rate = torchaudio.info(audio_fname).sample_rate
     audio_duration = audio.shape[1] / audio_sample_rate
-    n_frames = int(audio_duration / TIMESTEP_S)
-    return activation[:n_frames]
+    return int(audio_duration / TIMESTEP_S)
+
+
+def activation_length_from_audio_info(audio_fname: str) -> int:
+    """
+    Same as activation_length_from_audio_path, but reads the length from the file header instead of
+    decoding the audio, falling back to decoding when the header doesn't record it
+    """
+    info = torchaudio.info(audio_fname)
+    if info.num_frames <= 0:
+        return activation_length_from_audio_path(audio_fname)
+    return int(info.num_frames / info.sample_rate / TIMESTEP_S)
+
+
+def trim_activation(audio_fname: str, activation: torch.Tensor) -> torch.Tensor:
+    """
+    Trim the activation tensor to match the duration of the audio file
+    """
+    return activation[: activation_length_from_audio_path(audio_fname)]
 
 
 def activation_length_from_audio_array(audio_array: np.ndarray) -> torch.Tensor:
@@ -132,6 +152,174 @@ def top_activations(
     return pq, None if not return_max_per_file else max_per_file
 
 
+class FeatureExtrema(NamedTuple):
+    feature_max: np.ndarray
+    """Max activation of each feature in each file, shape (n_features, n_files)."""
+
+    feature_min: np.ndarray
+    """Min activation of each feature in each file, shape (n_features, n_files)."""
+
+    n_frames: np.ndarray
+    """Length of each file's trimmed activation, shape (n_files,)."""
+
+
+def feature_extrema_files(data_path: str, layer_name: str) -> list[str]:
+    return [
+        os.path.join(data_path, f"{layer_name}_feature_max.npy"),
+        os.path.join(data_path, f"{layer_name}_feature_min.npy"),
+        os.path.join(data_path, f"{layer_name}_n_frames.npy"),
+    ]
+
+
+def _open_extrema_file(
+    path: str, shape: tuple[int, ...], dtype: np.dtype = np.float32
+) -> np.ndarray:
+    try:
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+    except OSError:
+        warnings.warn(f"Can't write {path}, keeping feature index in memory")
+        return np.empty(shape, dtype=dtype)
+
+
+@torch.no_grad()
+def build_feature_extrema(
+    dataset: MemoryMappedActivationsDataset, tile_bytes: int = 256 * 2**20
+) -> FeatureExtrema:
+    """
+    Scan the dataset once, recording the max and min activation of every feature over each file's
+    trimmed duration. The tables are stored feature-major so that a single feature is one contiguous row.
+
+    :param dataset: MemoryMappedActivationsDataset
+    :param tile_bytes: approximate number of bytes to read from the memory-mapped files, and to
+        buffer for the tables, at a time
+    :return: FeatureExtrema, also saved next to the dataset's memory-mapped files
+    """
+    print("Building feature index...")
+    n_files = len(dataset)
+    n_features = dataset.activation_shape[-1]
+    if dataset.activation_type == "tensor":
+        value_mmaps = [dataset.mmap]
+    else:
+        value_mmaps = [dataset.act_mmap, dataset.idx_mmap]
+    file_nbytes = sum(m.dtype.itemsize for m in value_mmaps) * int(
+        np.prod(dataset.metadata["tensor_shape"])
+    )
+    read_files = max(1, tile_bytes // file_nbytes)
+    # columns of feature_max and feature_min buffered before writing to the feature-major tables
+    write_files = max(read_files, tile_bytes // (2 * n_features * 4))
+
+    paths = feature_extrema_files(dataset.data_path, dataset.layer_name)
+    tmp_paths = [f"{path}.tmp" for path in paths]
+    feature_max = _open_extrema_file(tmp_paths[0], (n_features, n_files))
+    feature_min = _open_extrema_file(tmp_paths[1], (n_features, n_files))
+    n_frames = _open_extrema_file(tmp_paths[2], (n_files,), np.int64)
+    filenames = dataset.metadata["filenames"]
+    with tqdm(total=n_files) as pbar:
+        for write_start in range(0, n_files, write_files):
+            write_stop = min(write_start + write_files, n_files)
+            tile_max = torch.zeros(write_stop - write_start, n_features)
+            tile_min = torch.zeros(write_stop - write_start, n_features)
+            for read_start in range(write_start, write_stop, read_files):
+                read_stop = min(read_start + read_files, write_stop)
+                batch = dataset.collate([dataset[i] for i in range(read_start, read_stop)])
+                for j, i in enumerate(range(read_start, read_stop)):
+                    length = activation_length_from_audio_info(filenames[i])
+                    n_frames[i] = length
+                    k = i - write_start
+                    if dataset.activation_type == "tensor":
+                        act = batch[0][j, :length].float()
+                        tile_max[k] = act.max(dim=0).values
+                        tile_min[k] = act.min(dim=0).values
+                    else:
+                        # features outside the top k at a timestep count as 0, as in activation_tensor_from_indexed
+                        values = batch[0][j, :length].flatten().float()
+                        indices = batch[1][j, :length].flatten().long()
+                        tile_max[k].scatter_reduce_(0, indices, values, "amax")
+                        tile_min[k].scatter_reduce_(0, indices, values, "amin")
+                del batch
+                pbar.update(read_stop - read_start)
+            feature_max[:, write_start:write_stop] = tile_max.T.numpy()
+            feature_min[:, write_start:write_stop] = tile_min.T.numpy()
+    for array, tmp_path, path in zip((feature_max, feature_min, n_frames), tmp_paths, paths):
+        if isinstance(array, np.memmap):
+            array.flush()
+            os.replace(tmp_path, path)
+    print("Feature index built.")
+    return FeatureExtrema(feature_max, feature_min, n_frames)
+
+
+def load_feature_extrema(dataset: MemoryMappedActivationsDataset) -> FeatureExtrema:
+    """
+    Load the feature index saved next to the dataset's memory-mapped files, building it if it is
+    missing, older than the activations or covers fewer files than the dataset
+    """
+    paths = feature_extrema_files(dataset.data_path, dataset.layer_name)
+    if dataset.activation_type == "tensor":
+        data_files = [dataset.tensor_file]
+    else:
+        data_files = [dataset.activation_value_file, dataset.feature_index_file]
+    data_mtime = max(os.path.getmtime(f) for f in data_files + [dataset.metadata_file])
+    if all(os.path.exists(p) and os.path.getmtime(p) >= data_mtime for p in paths):
+        feature_max, feature_min, n_frames = [np.load(p, mmap_mode="r") for p in paths]
+        if len(n_frames) >= len(dataset):
+            return FeatureExtrema(feature_max, feature_min, n_frames)
+    return build_feature_extrema(dataset)
+
+
+@torch.no_grad()
+def top_activations_from_extrema(
+    dataset: MemoryMappedActivationsDataset,
+    extrema: FeatureExtrema,
+    feature_idx: int,
+    n_files: int,
+    max_val: Optional[float],
+    min_val: Optional[float],
+    absolute_magnitude: bool,
+    return_max_per_file: bool,
+) -> tuple[list[tuple[str, torch.Tensor, float, float]], Optional[np.ndarray]]:
+    """
+    Same as top_activations, but ranks files using a precomputed FeatureExtrema index so that only
+    one row of the index and the activations of the returned files are read. Max per file is
+    returned as an array rather than a list.
+    """
+    n_dataset_files = len(dataset)
+    feature_max = torch.from_numpy(
+        np.array(extrema.feature_max[feature_idx, :n_dataset_files])
+    )
+    if absolute_magnitude:
+        feature_min = torch.from_numpy(
+            np.array(extrema.feature_min[feature_idx, :n_dataset_files])
+        )
+        signed_values = torch.where(-feature_min > feature_max, feature_min, feature_max)
+        values = signed_values.abs()
+    else:
+        signed_values = values = feature_max
+    allowed = torch.ones(n_dataset_files, dtype=torch.bool)
+    if max_val is not None:
+        allowed &= signed_values <= max_val
+    if min_val is not None:
+        allowed &= signed_values >= min_val
+    n_top = min(n_files, int(allowed.sum()))
+    top_idx = values.masked_fill(~allowed, -float("inf")).topk(n_top).indices
+
+    pq = []
+    for i in top_idx.tolist():
+        length = int(extrema.n_frames[i])
+        if dataset.activation_type == "tensor":
+            # copy only the feature's column out of the mmap rather than the whole row
+            row = dataset.mmap[i].reshape(dataset._row_shape)
+            trimmed_activation = torch.from_numpy(np.array(row[:length, feature_idx]))
+            filename = dataset[i][1]
+        else:
+            batch = dataset.collate([dataset[i]])
+            act = activation_tensor_from_indexed(batch[0], batch[1], feature_idx)[0]
+            trimmed_activation = act[:length]
+            filename = batch[-1][0]
+        max_activation_time = trimmed_activation.argmax().item() * TIMESTEP_S
+        pq.append((filename, trimmed_activation, values[i].item(), max_activation_time))
+    return pq, None if not return_max_per_file else signed_values.numpy()
+
+
 @torch.no_grad()
 def top_activations_for_audio(
     audio_array: np.ndarray,
@@ -116,7 +116,7 @@ def get_mels_from_audio_path(
 
 
 def get_mels_from_np_array(device, audio: np.ndarray, n_mels: int):
-    audio = audio.astype(np.float32)
+    audio = audio.astype(np.float32, copy=False)
     with torch.no_grad():
         audio = pad_or_trim(audio.flatten())
         mels = log_mel_spectrogram(audio, device=device, n_mels=n_mels)